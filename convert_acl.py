@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import os
+import queue
+import re
+import shutil
+import signal
 import subprocess
-import shlex
 import sys
 import threading
+import time
 
 from tree_walk import Callback
 from tree_walk import ParallelTreeWalk
@@ -48,66 +54,99 @@ __copyright__ = "Copyright 2022, Quobyte Inc"
 
 
 SPECIAL_PRINCIPALS = ["OWNER@", "GROUP@", "EVERYONE@"]
+SPECIAL_INDEX = {principal: idx
+                 for idx, principal in enumerate(SPECIAL_PRINCIPALS)}
+GETFACL_FILE_HEADER_RE = re.compile(rb"^# file: (.*)$", re.MULTILINE)
 
+_INHERIT = frozenset("ifd")
+# matches ACE lines with an inheritance flag and captures their principal
+_INHERITING_ACE_RE = re.compile(
+    rb"^(?!#)[^:\n]*:[^:\n]*[ifd][^:\n]*:([^:\n]*):", re.MULTILINE)
+_SPECIAL_PRINCIPALS_BYTES = frozenset(
+    principal.encode() for principal in SPECIAL_PRINCIPALS)
 
-class TextAce:
-    """ Represents a single line of a nfs4_getacl output """
-    def __init__(self, string: str) -> None:
-        data = string.split(":")
-        assert len(data) == 4
-        self._type = data[0]
-        self._flags = data[1]
-        self._principal = data[2]
-        self._permissions = data[3]
 
-    def hasInheritanceFlag(self) -> bool:
-        return any(flag in self._flags for flag in ['i', 'f', 'd'])
-
-    def hasSpecialPrincipal(self) -> bool:
-        for principal in SPECIAL_PRINCIPALS:
-            if self._principal == principal:
-                return True
-        return False
-
-    def getType(self) -> str:
-        return self._type
-
-    def getFlags(self) -> str:
-        return self._flags
-
-    def getPrincipal(self) -> str:
-        return self._principal
-
-    def getPermissions(self) -> str:
-        return self._permissions
-
-    def isAllowAce(self) -> bool:
-        return self._type == "A"
+def _tallyAces(types: list, inherit: list, principal_idx: list) -> tuple:
+    """
+    Counts in a single pass over the parallel ACE lists of an Acl.
 
-    def isDenyAce(self) -> bool:
-        return self._type == "D"
+    Returns a tuple of
+      - whether any ACE sets inheritance
+      - the number of special principals with an ACE that sets inheritance
+      - per special principal the number of ACEs that set inheritance and
+        the number of allow and deny ACEs that don't
 
-    def toString(self) -> str:
-        return "{}:{}:{}:{}{}".format(
-            self._type, self._flags, self._principal, self._permissions,
-            os.linesep)
+    Stops early once all special principals have an ACE that sets
+    inheritance.
+    """
+    counts = [[0, 0, 0] for _ in SPECIAL_PRINCIPALS]
+    has_inheritance = False
+    num_inheriting = 0
+    for ace_type, ace_inherit, idx in zip(types, inherit, principal_idx):
+        if ace_inherit:
+            has_inheritance = True
+        if idx < 0:
+            continue
+        count = counts[idx]
+        if ace_inherit:
+            if count[0] == 0:
+                num_inheriting = num_inheriting + 1
+                if num_inheriting == len(SPECIAL_PRINCIPALS):
+                    break
+            count[0] = count[0] + 1
+        elif ace_type == "A":
+            count[1] = count[1] + 1
+        elif ace_type == "D":
+            count[2] = count[2] + 1
+    return has_inheritance, num_inheriting, counts
 
 
 class Acl:
     """
-    Stores the output of nfs4_getacl as individual ACEs and does the
-    conversion
+    Stores the output of nfs4_getacl and does the conversion. The fields of
+    the ACEs are kept in parallel lists, one entry per line of the output.
+    The predicates needed for the conversion are computed once per ACE.
     """
-    def __init__(self, string: str) -> None:
-        self._aces = []
-        self._added_aces = []
-
-        for line in string.split(os.linesep):
-            if (len(line) == 0):
-                continue
-            if line[0] == "#":
+    def __init__(self, data: bytes) -> None:
+        self._types = []
+        self._flags = []
+        self._principals = []
+        self._permissions = []
+        # whether the ACE has an inheritance flag
+        self._inherit = []
+        # index into SPECIAL_PRINCIPALS or -1 for other principals
+        self._principal_idx = []
+
+        for line in data.splitlines():
+            if len(line) == 0 or line[:1] == b"#":
                 continue
-            self._aces.append(TextAce(line))
+            fields = line.decode().split(":")
+            assert len(fields) == 4
+            ace_type, flags, principal, permissions = fields
+            self._types.append(ace_type)
+            self._flags.append(flags)
+            self._principals.append(principal)
+            self._permissions.append(permissions)
+            self._inherit.append(not _INHERIT.isdisjoint(flags))
+            self._principal_idx.append(SPECIAL_INDEX.get(principal, -1))
+
+        # ACEs at or after this index have been added by convert()
+        self._num_aces = len(self._types)
+
+    @staticmethod
+    def needsConversion(data: bytes) -> bool:
+        """
+        Checks the raw nfs4_getfacl output without parsing it into ACEs.
+        Returns false if convert() would return false because there is no
+        ACE that sets inheritance or there is one for each special
+        principal.
+        """
+        inheriting = set()
+        for match in _INHERITING_ACE_RE.finditer(data):
+            inheriting.add(match.group(1))
+        if len(inheriting) == 0:
+            return False
+        return not _SPECIAL_PRINCIPALS_BYTES.issubset(inheriting)
 
     def convert(self) -> bool:
         """
@@ -118,132 +157,372 @@ class Acl:
           An exception is raised if the ACL cannot be converted
         """
 
+        has_inheritance, num_inheriting, counts = _tallyAces(
+            self._types, self._inherit, self._principal_idx)
+        if num_inheriting == len(SPECIAL_PRINCIPALS):
+            # there are ACEs with inheritance for all special principals
+            return False
+
         #  - there is at least one ACE that sets inheritance for a non-special
         #    principal
-        if sum(1 for ace in self._aces if ace.hasInheritanceFlag()) == 0:
+        if not has_inheritance:
             return False
 
         #  - there is no ACE that sets inheritance for any special principal
-        num_aces = 0
-        for principal in SPECIAL_PRINCIPALS:
-            if sum(1 for ace in self._aces
-                   if ace.hasInheritanceFlag() and
-                   ace.getPrincipal() == principal) > 0:
-                num_aces = num_aces + 1
-
-        if num_aces == len(SPECIAL_PRINCIPALS):
-            # there are ACEs with inheritance for all special principals
-            return False
-
-        if num_aces > 0:
+        if num_inheriting > 0:
             raise RuntimeError("Cannot convert ACL as inheritance is not set "
                                "for all special principals")
 
         #  - there is exactly one allow ACE for each special principal
         #  - there is no deny ACE for any special principal
-        for principal in SPECIAL_PRINCIPALS:
-            num_allow_aces = sum(1 for ace in self._aces
-                                 if ace.getPrincipal() == principal and
-                                 ace.isAllowAce() and not
-                                 ace.hasInheritanceFlag())
-            num_deny_aces = sum(1 for ace in self._aces
-                                if ace.getPrincipal() == principal and
-                                ace.isDenyAce() and not
-                                ace.hasInheritanceFlag())
+        for principal, count in zip(SPECIAL_PRINCIPALS, counts):
+            _, num_allow_aces, num_deny_aces = count
             if num_allow_aces > 1 or num_deny_aces > 1:
                 raise RuntimeError(
                     "Cannot convert ACL as there are too many rules for "
                     "principal {} ".format(principal))
 
-        for ace in self._aces:
-            if ace.isAllowAce() and ace.hasSpecialPrincipal():
-                new_ace = TextAce("{}:fdi{}:{}:{}".format(
-                    ace.getType(),
-                    ace.getFlags(),
-                    ace.getPrincipal(),
-                    ace.getPermissions()))
-                self._added_aces.append(new_ace)
+        for i in range(self._num_aces):
+            if self._types[i] == "A" and self._principal_idx[i] >= 0:
+                self._types.append(self._types[i])
+                self._flags.append("fdi" + self._flags[i])
+                self._principals.append(self._principals[i])
+                self._permissions.append(self._permissions[i])
+                self._inherit.append(True)
+                self._principal_idx.append(self._principal_idx[i])
         return True
 
+    def getNumAces(self) -> int:
+        """ Returns the number of ACEs before the conversion """
+        return self._num_aces
+
     def toString(self) -> str:
-        result = ""
-        for ace in self._aces:
-            result += ace.toString()
-        for ace in self._added_aces:
-            result += ace.toString()
-        return result
+        return self._acesToString(0)
+
+    def addedAcesToString(self) -> str:
+        """ Returns only the ACEs added by convert() """
+        return self._acesToString(self._num_aces)
+
+    def _acesToString(self, start: int) -> str:
+        lines = [f"{ace_type}:{flags}:{principal}:{permissions}"
+                 for ace_type, flags, principal, permissions
+                 in zip(self._types[start:], self._flags[start:],
+                        self._principals[start:], self._permissions[start:])]
+        lines.append("")
+        return "\n".join(lines)
+
+
+def splitGetfaclOutput(data: bytes, paths: list) -> list:
+    """
+    Splits the raw output of a nfs4_getfacl call for several paths into one
+    ACL per path. Every ACL is introduced by a "# file: <path>" line.
+
+    Returns None if the output does not match the given paths.
+    """
+    headers = list(GETFACL_FILE_HEADER_RE.finditer(data))
+    if len(headers) != len(paths):
+        return None
+    blocks = []
+    for i, (path, header) in enumerate(zip(paths, headers)):
+        if header.group(1) != os.fsencode(path):
+            return None
+        end = len(data)
+        if i + 1 < len(headers):
+            end = headers[i + 1].start()
+        blocks.append(data[header.end():end])
+    return blocks
+
+
+class _BatchFlusher(threading.Thread):
+    """
+    Collects the paths of directories to convert and hands them to the
+    converter in batches of up to batch_size paths. A partial batch is
+    handed out after max_delay seconds. add() blocks while batch_size paths
+    are waiting, so the tree walk cannot get ahead of the conversion.
+    """
+    def __init__(self, flush, batch_size: int, max_delay: float) -> None:
+        super().__init__(daemon=True)
+        self._flush = flush
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._queue = queue.Queue(maxsize=batch_size)
+
+    def add(self, path: str) -> None:
+        self._queue.put(path)
+
+    def close(self) -> None:
+        """ Flushes the pending paths and waits for the thread to finish """
+        self._queue.put(None)
+        self.join()
+
+    def run(self) -> None:
+        batch = []
+        deadline = 0
+        while True:
+            try:
+                timeout = None
+                if len(batch) > 0:
+                    timeout = max(0, deadline - time.monotonic())
+                path = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush(batch)
+                batch = []
+                continue
+
+            if path is None:
+                if len(batch) > 0:
+                    self._flush(batch)
+                return
+
+            if len(batch) == 0:
+                deadline = time.monotonic() + self._max_delay
+            batch.append(path)
+            if len(batch) >= self._batch_size:
+                self._flush(batch)
+                batch = []
 
 
 """
-Fetches the ACL via nfs4_getacl converts and maybe writes the result back.
-Acts as callback to the tree walk.
+Fetches the ACLs of a batch of directories via nfs4_getacl, converts and
+maybe writes the results back. Runs in a worker process of the converter,
+so messages and errors are collected and returned instead of logged.
+"""
+
+
+class BatchProcessor:
+    def __init__(self, getfacl: str, setfacl: str, dry_run: bool) -> None:
+        self._getfacl = getfacl
+        self._setfacl = setfacl
+        self._dry_run = dry_run
+
+    def __call__(self, paths: list) -> tuple:
+        """ Returns the messages and a list of (path, error) tuples """
+        messages = []
+        errors = []
+        groups = self._convert(self._getAcls(paths, errors), messages, errors)
+        # nfs4_setfacl applies the ACEs to all paths given, so directories
+        # that get the same ACEs at the same index are written by one call
+        for (aces, index), group in groups.items():
+            self._addAces(aces, index, group, errors)
+        return messages, errors
+
+    def _convert(self, acls: list, messages: list, errors: list) -> dict:
+        """
+        Converts the (path, nfs4_getfacl output) tuples of acls. Returns the
+        paths to write grouped by the added ACEs and their 1-based index, the
+        conversion only appends ACEs so only those are sent.
+        """
+        groups = {}
+        for path, data in acls:
+            # most directories need no conversion, skip them before parsing
+            if not Acl.needsConversion(data):
+                continue
+            try:
+                acl = Acl(data)
+                if not acl.convert():
+                    continue
+            except Exception as ex:
+                errors.append((path, str(ex)))
+                continue
+
+            if self._dry_run:
+                messages.append(
+                    "{}{}{}".format(path, os.linesep, acl.toString()))
+            else:
+                key = (acl.addedAcesToString(), acl.getNumAces() + 1)
+                groups.setdefault(key, []).append(path)
+        return groups
+
+    def _getAcls(self, paths: list, errors: list) -> list:
+        """ Returns a list of (path, nfs4_getfacl output) tuples """
+        try:
+            get_out = subprocess.run(
+                [self._getfacl] + paths,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            acls = None
+            if get_out.returncode == 0:
+                acls = splitGetfaclOutput(get_out.stdout, paths)
+        except Exception as ex:
+            if len(paths) == 1:
+                errors.append((paths[0], str(ex)))
+                return []
+            acls = None
+
+        if acls is None:
+            if len(paths) > 1:
+                # retry one by one to find the failing path
+                result = []
+                for path in paths:
+                    result.extend(self._getAcls([path], errors))
+                return result
+            if get_out.returncode != 0:
+                errors.append((paths[0],
+                               "Failed to run nfs4_getfacl: {}".format(
+                                   get_out.stderr.decode().strip())))
+                return []
+            acls = [get_out.stdout]
+        return list(zip(paths, acls))
+
+    def _addAces(self, aces: str, index: int, paths: list,
+                 errors: list) -> None:
+        """ Inserts the ACEs at the 1-based index of the ACLs of paths """
+        try:
+            set_out = subprocess.run(
+                [self._setfacl, "-A", "-", str(index)] + paths,
+                input=aces.encode(),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=False
+            )
+            if set_out.returncode == 0:
+                return
+            error = "Failed to run nfs4_setfacl: {}".format(
+                set_out.stderr.decode().strip())
+        except Exception as ex:
+            error = str(ex)
+
+        if len(paths) == 1:
+            errors.append((paths[0], error))
+            return
+
+        # Adding ACEs is not idempotent and the failed call may have written
+        # some of the paths already. Fetch the ACLs again and retry one by
+        # one only the paths that still need the conversion.
+        groups = self._convert(self._getAcls(paths, errors), [], errors)
+        for (retry_aces, retry_index), group in groups.items():
+            for path in group:
+                self._addAces(retry_aces, retry_index, [path], errors)
+
+
+def _ignoreSigint() -> None:
+    """
+    Runs in each worker process. Ctrl-C is handled by the main process,
+    which cancels the outstanding batches.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+"""
+Collects the directories found by the tree walk and converts their ACLs in
+batches on a pool of worker processes, so that parsing and converting ACLs
+is not serialized by the GIL. Acts as callback to the tree walk.
 """
 
 
 class AclConverter(Callback):
+    BATCH_SIZE = 128
+    BATCH_DELAY = 0.05
+
     def __init__(self, options) -> None:
         super().__init__()
         self._options = options
-        self._lock = threading.Lock()
+        # resolve the tools once instead of a PATH search on every exec
+        self._processor = BatchProcessor(
+            shutil.which("nfs4_getfacl") or "nfs4_getfacl",
+            shutil.which("nfs4_setfacl") or "nfs4_setfacl",
+            options.dry_run)
+        # output is written by a single thread so that workers never
+        # contend on a lock for printing
+        self._log_queue = queue.SimpleQueue()
+        self._logger = threading.Thread(target=self._drainLogs, daemon=True)
+        self._logger.start()
+        # workers mostly wait for nfs4_getfacl and nfs4_setfacl, so the pool
+        # is sized like the tree walk rather than by the number of cores.
+        # Threads are running already, so don't fork the workers.
+        self._executor = ProcessPoolExecutor(
+            max_workers=options.num_threads,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_ignoreSigint)
+        # set if a batch could not be processed at all, e.g. because the pool
+        # broke after a worker was killed
+        self._incomplete = False
+        self._aborted = False
+        # limits the batches handed to the pool but not yet finished, the
+        # flusher and then the tree walk block when it is exhausted
+        self._in_flight = threading.BoundedSemaphore(2 * options.num_threads)
+        self._flusher = _BatchFlusher(self._submitBatch, self.BATCH_SIZE,
+                                      self.BATCH_DELAY)
+        self._flusher.start()
+
+    def processEntry(self, path: str, is_dir: bool) -> bool:
+        if is_dir:
+            self._flusher.add(path)
+        return is_dir
+
+    def close(self) -> bool:
+        """
+        Waits until all queued directories have been processed. Returns false
+        if some directories could not be processed at all.
+        """
+        self._flusher.close()
+        self._executor.shutdown(wait=True)
+        self._log_queue.put(None)
+        self._logger.join()
+        return not self._incomplete
 
-    def processEntry(self, path: str) -> bool:
+    def abort(self) -> None:
+        """
+        Cancels the batches that have not been started and returns without
+        waiting for the running ones, e.g. after Ctrl-C
+        """
+        self._aborted = True
+        self._incomplete = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._log_queue.put(None)
+        self._logger.join()
+
+    def _submitBatch(self, paths: list) -> None:
+        self._in_flight.acquire()
         try:
-            if not os.path.islink(path) and os.path.isdir(path):
-                self._processDirectory(path)
-                return True
+            future = self._executor.submit(self._processor, paths)
         except Exception as ex:
-            self.callOnError(path, ex)
-            pass
-        return False
-
-    def _processDirectory(self, path: str):
-        # get the ACL
-        get_out = subprocess.run(
-            shlex.split("nfs4_getfacl {}".format(path)),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        if get_out.returncode != 0:
-            self.callOnError(path, "Failed to run nfs4_getfacl: {}".format(
-                get_out.stderr.decode().strip()))
+            self._in_flight.release()
+            self._failBatch(paths, ex)
             return
+        future.add_done_callback(
+            lambda future: self._logBatchResult(paths, future))
 
-        # convert it
-        acl = Acl(get_out.stdout.decode())
-        if not acl.convert():
-            return
-
-        if self._options.dry_run:
-            self._logMessage("{}{}{}".format(path, os.linesep, acl.toString()))
+    def _logBatchResult(self, paths: list, future) -> None:
+        self._in_flight.release()
+        try:
+            messages, errors = future.result()
+        except BaseException as ex:
+            # also covers cancelled batches and a KeyboardInterrupt in a
+            # worker, which must not escape into the executor's thread
+            self._failBatch(paths, ex)
             return
-
-        # write back the converted result
-        set_out = subprocess.run(
-            f'echo "{acl.toString()}" | nfs4_setfacl -S - {path}',
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True
-        )
-        if set_out.returncode != 0:
-            self.callOnError(path, "Failed to run nfs4_setfacl: {}".format(
-                set_out.stderr.decode().strip()))
+        for message in messages:
+            self._logMessage(message)
+        for path, error in errors:
+            self.callOnError(path, error)
+
+    def _failBatch(self, paths: list, error) -> None:
+        self._incomplete = True
+        if self._aborted:
+            # the run has been interrupted, don't report every directory
             return
+        for path in paths:
+            self.callOnError(path, error)
 
     def _logMessage(self, message: str) -> None:
-        self._lock.acquire()
-        print(message)
-        self._lock.release()
+        self._log_queue.put((sys.stdout, message))
 
     def _logError(self, message: str) -> None:
-        self._lock.acquire()
-        print(message, file=sys.stderr)
-        self._lock.release()
+        self._log_queue.put((sys.stderr, message))
 
-    def callOnError(self, path: str, exception: Exception):
-        self.callOnError(path, str(exception))
+    def _drainLogs(self) -> None:
+        while True:
+            record = self._log_queue.get()
+            if record is None:
+                return
+            stream, message = record
+            print(message, file=stream)
 
-    def callOnError(self, path: str, error: str):
-        self._logError("Failed to process {}: {}".format(path, error))
+    def callOnError(self, path: str, error) -> None:
+        """ error is either an Exception or a message string """
+        self._logError("Failed to process {}: {}".format(path, str(error)))
 
 
 if __name__ == '__main__':
@@ -253,11 +532,27 @@ if __name__ == '__main__':
     parser.add_argument("directory")
     parser.add_argument('--num-threads',
                         default=30,
+                        type=int,
                         help='Number of threads for the parallel tree walk')
+    parser.add_argument('--bfs-depth',
+                        default=3,
+                        type=int,
+                        help='Depth from which on each subtree is walked by '
+                        'a single thread as long as no other thread is idle')
     parser.add_argument('--dry_run',
                         action='store_true',
                         help='Do not modify files but print the resulting ACL')
     options = parser.parse_args()
 
-    walk = ParallelTreeWalk(options.num_threads, AclConverter(options))
-    walk.run(options.directory)
+    converter = AclConverter(options)
+    walk = ParallelTreeWalk(options.num_threads, converter, options.bfs_depth)
+    try:
+        walk.run(options.directory)
+        complete = converter.close()
+    except KeyboardInterrupt:
+        converter.abort()
+        print("Interrupted, not all directories have been processed",
+              file=sys.stderr)
+        sys.exit(130)
+    if not complete:
+        sys.exit(1)
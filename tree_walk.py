@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
+import collections
 import os
+import random
 import threading
-import queue
 
 """ A parallel directory tree walk with custom callback """
 __copyright__ = "Copyright 2022, Quobyte Inc"
 
 
 class Callback:
-    def processEntry(self, path: str) -> bool:
+    def processEntry(self, path: str, is_dir: bool) -> bool:
         """
-        To return true if path points to a directory that shall be expanded
+        To return true if path points to a directory that shall be expanded.
+        is_dir is true if path is a directory and not a symlink.
         """
         pass
 
@@ -19,34 +21,156 @@ class Callback:
 
 
 class ParallelTreeWalk:
-    def __init__(self, num_threads: int, callback: Callback) -> None:
-        # A FIFO queue for breadth-first traversal
-        self._work_queue = queue.Queue()
+    # Maximum number of directories passed around as one work item while
+    # all threads are busy
+    BATCH_SIZE = 64
+    # Bounds of the back-off of a thread that found no work
+    MIN_IDLE_WAIT = 0.0005
+    MAX_IDLE_WAIT = 0.01
+
+    def __init__(self, num_threads: int, callback: Callback,
+                 bfs_depth: int = 3) -> None:
+        # The subtree of a directory at bfs_depth is walked depth-first by a
+        # single thread, which hands pending directories only to idle
+        # threads. None shares all depths through the deques.
+        self._bfs_depth = bfs_depth
+        # One deque of (depth, directory batch) tuples per thread. A thread
+        # pushes and pops at the left end of its own deque and steals from the
+        # right end of the others. Single appends and pops of a deque are
+        # atomic, so no lock is shared between the threads.
+        self._deques = [collections.deque() for _ in range(num_threads)]
         self._num_threads = num_threads
         self._callback = callback
+        # number of batches that have been pushed but not yet processed and
+        # number of threads that found no work. The latter is read without
+        # the lock as a hint to hand out smaller batches.
+        self._pending = 0
+        self._num_idle = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
 
     def start(self, path: str):
-        if self._callback.processEntry(path):
-            for i in range(self._num_threads):
-                threading.Thread(target=self._thread_task, daemon=True).start()
-            self._work_queue.put(path)
+        is_dir = not os.path.islink(path) and os.path.isdir(path)
+        if not self._callback.processEntry(path, is_dir):
+            self._done.set()
+            return
+        self._push(0, (0, [path]))
+        for i in range(self._num_threads):
+            threading.Thread(target=self._thread_task, args=(i,),
+                             daemon=True).start()
 
     def wait(self):
-        self._work_queue.join()
+        self._done.wait()
 
     def run(self, path: str):
         self.start(path)
         self.wait()
 
-    def _thread_task(self):
+    def _push(self, index: int, item: tuple):
+        with self._lock:
+            self._pending = self._pending + 1
+        self._deques[index].appendleft(item)
+
+    def _pushSplit(self, index: int, depth: int, paths: list):
+        """ Pushes paths in as many batches as there are idle threads """
+        num_batches = max(1, min(len(paths), self._num_idle))
+        size = -(-len(paths) // num_batches)
+        for start in range(0, len(paths), size):
+            self._push(index, (depth, paths[start:start + size]))
+
+    def _setIdle(self, idle: bool):
+        with self._lock:
+            self._num_idle = self._num_idle + (1 if idle else -1)
+
+    def _pop(self, index: int) -> tuple:
+        try:
+            return self._deques[index].popleft()
+        except IndexError:
+            pass
+        # steal from the other threads, starting at a random one
+        offset = random.randrange(self._num_threads)
+        for i in range(self._num_threads):
+            victim = (offset + i) % self._num_threads
+            if victim == index:
+                continue
+            try:
+                return self._deques[victim].pop()
+            except IndexError:
+                pass
+        return None
+
+    def _thread_task(self, index: int):
+        idle = False
+        idle_wait = self.MIN_IDLE_WAIT
         while True:
-            path = self._work_queue.get()
+            item = self._pop(index)
+            if item is None:
+                if not idle:
+                    idle = True
+                    self._setIdle(True)
+                if self._done.wait(idle_wait):
+                    return
+                idle_wait = min(idle_wait * 2, self.MAX_IDLE_WAIT)
+                continue
+            if idle:
+                idle = False
+                self._setIdle(False)
+            idle_wait = self.MIN_IDLE_WAIT
+
+            depth, paths = item
+            for i, path in enumerate(paths):
+                if i > 0 and self._num_idle > 0:
+                    # share the rest of the batch with the idle threads
+                    self._pushSplit(index, depth, paths[i:])
+                    break
+                if self._bfs_depth is not None and depth >= self._bfs_depth:
+                    self._walkSubtree(index, path)
+                else:
+                    self._expand(index, depth, path)
+            with self._lock:
+                self._pending = self._pending - 1
+                if self._pending == 0:
+                    self._done.set()
+
+    def _expand(self, index: int, depth: int, path: str):
+        batch = []
+        try:
+            for subdir in self._subdirectories(path):
+                batch.append(subdir)
+                if len(batch) >= self.BATCH_SIZE or self._num_idle > 0:
+                    self._push(index, (depth + 1, batch))
+                    batch = []
+        except Exception as e:
+            self._callback.callOnError(path, e)
+            pass
+        if len(batch) > 0:
+            self._push(index, (depth + 1, batch))
+
+    def _walkSubtree(self, index: int, path: str):
+        stack = [path]
+        while len(stack) > 0:
+            if len(stack) > 1 and self._num_idle > 0:
+                # share the pending directories with the idle threads
+                self._pushSplit(index, self._bfs_depth, stack[:-1])
+                del stack[:-1]
+            path = stack.pop()
             try:
-                for dentry in os.listdir(path):
-                    dentry_path = os.path.join(path, dentry)
-                    if self._callback.processEntry(dentry_path):
-                        self._work_queue.put(dentry_path)
+                stack.extend(self._subdirectories(path))
             except Exception as e:
                 self._callback.callOnError(path, e)
                 pass
-            self._work_queue.task_done()
+
+    def _subdirectories(self, path: str):
+        """ Yields the entries of path that the callback wants expanded """
+        with os.scandir(path) as it:
+            for dentry in it:
+                try:
+                    # served from readdir without a stat on most filesystems,
+                    # falls back to lstat() which may fail
+                    is_dir = dentry.is_dir(follow_symlinks=False)
+                    expand = self._callback.processEntry(dentry.path, is_dir)
+                except Exception as e:
+                    self._callback.callOnError(dentry.path, e)
+                    continue
+                if expand:
+                    yield dentry.path